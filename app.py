@@ -2,8 +2,12 @@
 import streamlit as st
 from PIL import Image
 import pandas as pd
+import numpy as np
 import yaml
-from yaml.loader import SafeLoader
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml.loader import SafeLoader
 import streamlit_authenticator as stauth
 import plotly.express as px
 from datetime import datetime, date
@@ -11,14 +15,29 @@ import smtplib
 from email.message import EmailMessage
 from dateutil.relativedelta import relativedelta
 import os
-import re
+import tempfile
+import threading
 
 # ---------------------------
 # Config / constants
 # ---------------------------
-EXCEL_PATH = "DB-CMC2.xlsx"
+EXCEL_PATH = "DB-CMC2.xlsx"  # legacy store, migrated to Parquet on first load
+PARQUET_PATH = "DB-CMC2.parquet"
+DB_CACHE_TTL = 60  # seconds
 FIXED_EXPIRY_YEARS = 4  # fallback if needed
 STATUS_OPTIONS = ["In use", "In stock", "Out of use"]
+MISSING_EXPIRY = "Missing expiry"
+_SEP = " - "  # separator before the date in pump IDs
+STATUS_ALIASES = {
+    "in maintenance": "In stock",
+    "not used yet": "In stock",
+    "disuse": "Out of use",
+    "out of order": "Out of use",
+    "in use": "In use",
+}
+# lowercase status -> canonical status, including the canonical values themselves
+STATUS_CANON = {k.lower(): v for k, v in STATUS_ALIASES.items()}
+STATUS_CANON.update({s.lower(): s for s in STATUS_OPTIONS})
 
 # ---------------------------
 # Branding and page config (must call set_page_config early)
@@ -46,66 +65,84 @@ def is_empty(val):
     except Exception:
         return False
 
+def is_crono_model(model):
+    return "CRONO SC" in str(model).upper()
+
 def parse_date_from_id(id_value):
+    # Same parser as the bulk path, so the Add Pump form and recomputed expiries agree
     if is_empty(id_value):
         return pd.NaT
-    try:
-        parts = re.split(r"\s-\s", str(id_value).strip())
-        date_candidate = parts[-1].strip()
-        parsed = pd.to_datetime(date_candidate, dayfirst=True, errors="coerce")
-        if pd.notna(parsed):
-            return parsed
-        parsed = pd.to_datetime(date_candidate, dayfirst=False, errors="coerce")
-        if pd.notna(parsed):
-            return parsed
-    except Exception:
-        pass
-    return pd.NaT
+    return parse_dates_from_ids(pd.Series([str(id_value)])).iloc[0]
+
+def parse_dates(values):
+    """Parse each value on its own, trying day-first then month-first."""
+    # format="mixed" stops pandas from inferring one format from the first element
+    d1 = pd.to_datetime(values, format="mixed", dayfirst=True, errors="coerce")
+    d2 = pd.to_datetime(values, format="mixed", dayfirst=False, errors="coerce")
+    return d1.combine_first(d2)
+
+def parse_dates_from_ids(series):
+    """Parse the trailing date of each pump ID, trying day-first then month-first."""
+    tail = series.astype("string").str.rsplit(_SEP, n=1).str[-1].str.strip()
+    return parse_dates(tail)
 
 # ---------------------------
 # Email sending (silent failures)
 # ---------------------------
-def send_email(to_email, subject, body):
+def send_batch(messages):
+    """Send (to, subject, body) tuples over a single SMTP session."""
     EMAIL = st.secrets.get("email_user") if isinstance(st.secrets, dict) else st.secrets.get("email_user", None)
     PASS = st.secrets.get("email_pass") if isinstance(st.secrets, dict) else st.secrets.get("email_pass", None)
     if not EMAIL or not PASS:
         return False
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = EMAIL
-    msg["To"] = to_email
-    msg.set_content(body)
+    pending = []
+    seen = set()
+    for to_email, subject, body in messages:
+        # Subjects repeat across pumps sharing an invoice ID, so only drop exact duplicates
+        if (to_email, subject, body) in seen:
+            continue
+        seen.add((to_email, subject, body))
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        msg["From"] = EMAIL
+        msg["To"] = to_email
+        msg.set_content(body)
+        pending.append(msg)
+    if not pending:
+        return True
+
+    def deliver(smtp):
+        smtp.login(EMAIL, PASS)
+        # Drop each message once sent so the fallback only retries the rest
+        while pending:
+            smtp.send_message(pending[0])
+            st.success(f"✅ Email sent to {pending.pop(0)['To']}")
+
     try:
         with smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=10) as smtp:
-            smtp.login(EMAIL, PASS)
-            smtp.send_message(msg)
-            st.success(f"✅ Email sent to {to_email}")
+            deliver(smtp)
             return True
     except Exception:
         try:
             with smtplib.SMTP("smtp.gmail.com", 587, timeout=10) as smtp:
                 smtp.starttls()
-                smtp.login(EMAIL, PASS)
-                smtp.send_message(msg)
-                st.success(f"✅ Email sent to {to_email}")
+                deliver(smtp)
                 return True
         except Exception:
             return False
 
+def send_email(to_email, subject, body):
+    return send_batch([(to_email, subject, body)])
+
 # ---------------------------
 # DB load/save
 # ---------------------------
-@st.cache_data(ttl=60)
-def load_db():
-    if not os.path.exists(EXCEL_PATH):
-        cols = ["ID", "Client", "Model", "Quantity Sold", "Serial Number", "Year", "Status",
-                "Last Updated", "Expiry", "Patient", "Notes"]
-        df_empty = pd.DataFrame(columns=cols)
-        df_empty.to_excel(EXCEL_PATH, index=False)
-    try:
-        df = pd.read_excel(EXCEL_PATH, engine="openpyxl")
-    except Exception:
-        df = pd.read_excel(EXCEL_PATH)
+DB_COLUMNS = ["ID", "Client", "Model", "Quantity Sold", "Serial Number", "Year", "Status",
+              "Last Updated", "Expiry", "Patient", "Notes"]
+CATEGORY_COLUMNS = ("Client", "Model")
+STRING_COLUMNS = ("Serial Number", "Notes", "Patient")
+
+def normalize_db(df):
     df.columns = df.columns.str.strip()
     if "Last Updated" not in df.columns:
         df["Last Updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -117,50 +154,154 @@ def load_db():
         df["Quantity Sold"] = 0
     if "Notes" not in df.columns:
         df["Notes"] = ""
-    df["Status"] = df.get("Status", "In stock").fillna("In stock")
-    lower_map = {
-        "in maintenance": "In stock",
-        "not used yet": "In stock",
-        "disuse": "Out of use",
-        "out of order": "Out of use",
-        "in use": "In use",
-    }
-    df["Status"] = df["Status"].astype(str).str.strip().map(lambda s: lower_map.get(s.lower(), s))
-    df["Status"] = df["Status"].apply(lambda s: s if s in STATUS_OPTIONS else "In stock")
+    # Cast before fillna: a categorical Status read back from Parquet may not have "In stock" as a category
+    if "Status" in df.columns:
+        status = df["Status"].astype("string")
+    else:
+        status = pd.Series("In stock", index=df.index, dtype="string")
+    status = status.fillna("In stock").str.strip()
+    df["Status"] = status.str.lower().map(STATUS_CANON).fillna(status)
+    df["Status"] = df["Status"].where(df["Status"].isin(STATUS_OPTIONS), "In stock")
     if "Year" in df.columns:
         try:
             df["Year"] = pd.to_numeric(df["Year"], errors="coerce").astype("Int64")
         except Exception:
             pass
 
-    def compute_expiry(row):
-        exp = row.get("Expiry", pd.NaT)
+    exp_parsed = parse_dates(df["Expiry"])
+    # Only blank cells fall back to the ID date; unparseable text stays NaT and is flagged
+    exp_blank = df["Expiry"].isna() | (df["Expiry"].astype("string").str.strip() == "")
+    id_date = parse_dates_from_ids(df["ID"])
+    df["Expiry"] = exp_parsed.where(~exp_blank, id_date + pd.DateOffset(years=FIXED_EXPIRY_YEARS))
+    # Derived, not persisted: saves one case-insensitive scan of Model per check
+    df["_is_crono"] = df["Model"].astype("string").str.upper().str.contains("CRONO SC", na=False, regex=False).astype(bool)
+    for c in CATEGORY_COLUMNS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    # Fixed categories keep Status comparisons on integer codes, even for unused options
+    df["Status"] = pd.Categorical(df["Status"], categories=STATUS_OPTIONS)
+    for c in STRING_COLUMNS:
+        if c in df.columns:
+            df[c] = df[c].astype("string[pyarrow]")
+    return df
+
+def add_categories(df, values):
+    # Categorical columns only accept known values; register new ones before writing them.
+    # Blank text is stored as NA (in values, in place) rather than as an "" category.
+    for col, val in list(values.items()):
+        if col not in df.columns or not isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        if isinstance(val, str) and val.strip() == "":
+            values[col] = pd.NA
+        elif not pd.isna(val) and val not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories([val])
+
+def to_parquet_db(df):
+    # Parquet needs one type per column; free-text columns may mix numbers and strings.
+    out = df.drop(columns=["_is_crono"], errors="ignore")
+    for col in ("Year", "Quantity Sold"):
+        if col in out.columns:
+            try:
+                out[col] = pd.to_numeric(out[col], errors="coerce").astype("Int32")
+            except Exception:
+                pass
+    # Categoricals are a load-time optimization; store them as plain strings
+    for col in out.columns:
+        if out[col].dtype == object or isinstance(out[col].dtype, pd.CategoricalDtype):
+            out[col] = out[col].astype("string")
+    # Write beside the target and swap it in, so readers never see a half-written file
+    fd, tmp_path = tempfile.mkstemp(suffix=".parquet", dir=os.path.dirname(os.path.abspath(PARQUET_PATH)))
+    os.close(fd)
+    try:
+        out.to_parquet(tmp_path, index=False, compression="snappy")
+        os.replace(tmp_path, PARQUET_PATH)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def migrate_excel_db():
+    if os.path.exists(EXCEL_PATH):
         try:
-            parsed = pd.to_datetime(exp, errors="coerce")
-            if pd.notna(parsed):
-                return parsed
+            df = pd.read_excel(EXCEL_PATH, engine="openpyxl")
         except Exception:
-            pass
-        id_val = row.get("ID", "")
-        id_date = parse_date_from_id(id_val)
-        if pd.notna(id_date):
-            return id_date + relativedelta(years=FIXED_EXPIRY_YEARS)
-        return pd.NaT
+            df = pd.read_excel(EXCEL_PATH)
+    else:
+        df = pd.DataFrame(columns=DB_COLUMNS)
+    to_parquet_db(normalize_db(df))
 
-    df["Expiry"] = df.apply(compute_expiry, axis=1)
-    return df
+@st.cache_data(ttl=DB_CACHE_TTL)
+def load_db(client=None):
+    if not os.path.exists(PARQUET_PATH):
+        migrate_excel_db()
+    filters = [("Client", "==", client)] if client is not None else None
+    df = pd.read_parquet(PARQUET_PATH, filters=filters)
+    return normalize_db(df)
+
+_db_write_lock = threading.Lock()
+
+def get_db(client=None):
+    # Remember the scope so save_db knows whether df holds one client or everyone
+    st.session_state["_db_scope"] = client
+    return load_db(client)
 
 def save_db(df):
-    try:
-        df.to_excel(EXCEL_PATH, index=False)
-    except Exception:
-        return False
+    client = st.session_state.get("_db_scope")
+    with _db_write_lock:
+        try:
+            if client is not None:
+                # df only holds this client's rows; keep everyone else's as stored
+                stored = pd.read_parquet(PARQUET_PATH)
+                df = pd.concat([stored[stored["Client"] != client], df], ignore_index=True)
+            to_parquet_db(df)
+        except Exception:
+            return False
     try:
         load_db.clear()
     except Exception:
         pass
     return True
 
+def queue_pending_row(row):
+    # A resubmitted form replaces its earlier copy instead of queueing the pump twice
+    key = (row.get("ID"), row.get("Serial Number"))
+    pending = st.session_state.setdefault("_pending_rows", [])
+    pending[:] = [r for r in pending if (r.get("ID"), r.get("Serial Number")) != key]
+    pending.append(row)
+
+def pending_patient_count(patient, key=None):
+    # Queued CRONO SC pumps for this patient, ignoring the queued copy of the pump being resubmitted
+    return sum(1 for r in st.session_state.get("_pending_rows", [])
+               if r.get("_is_crono") and r.get("Patient") == patient
+               and (r.get("ID"), r.get("Serial Number")) != key)
+
+def _pending_frame(df, rows):
+    for row in rows:
+        add_categories(df, row)
+    new_rows = pd.DataFrame(rows)
+    return new_rows.astype({c: df.dtypes[c] for c in new_rows.columns if c in df.columns})
+
+def flush_pending_rows(df):
+    # Rows queued in st.session_state["_pending_rows"] are appended with a single concat;
+    # they stay queued until the save succeeds
+    pending = st.session_state.get("_pending_rows")
+    if not pending:
+        return df, True
+    try:
+        new_rows = _pending_frame(df, pending)
+    except Exception:
+        # Drop the rows that cannot take df's dtypes so they don't block later adds
+        for row in list(pending):
+            try:
+                _pending_frame(df, [row])
+            except Exception:
+                pending.remove(row)
+        raise
+    updated = pd.concat([df, new_rows], ignore_index=True)
+    if not save_db(updated):
+        return df, False
+    pending.clear()
+    return updated, True
+
 # ---------------------------
 # Filters
 # ---------------------------
@@ -175,11 +316,15 @@ def apply_filters(df, user, context="default"):
                 cols.append("WarningType")
         for col in cols:
             if col in df.columns:
-                options = sorted([o for o in df[col].dropna().unique()])
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    options = sorted(df[col].cat.remove_unused_categories().cat.categories)
+                else:
+                    options = sorted([o for o in df[col].dropna().unique()])
                 if options:
                     key = f"{context}_filter_{col}"
                     selected = st.multiselect(f"{col}", options, default=options, key=key)
-                    if selected:
+                    # Everything selected is the default no-op; skip the mask and row copy
+                    if selected and set(selected) != set(options):
                         df = df[df[col].isin(selected)]
     return df
 
@@ -188,62 +333,66 @@ def apply_filters(df, user, context="default"):
 # ---------------------------
 def check_expirations(df, current_user):
     now = datetime.now()
+    # Reruns happen on every widget interaction; sweep (and email) at most once per user and day
+    key = f"_chk_{current_user.get('username', current_user.get('email'))}_{now:%Y%m%d}"
+    if st.session_state.get(key):
+        return
     near_6m = now + relativedelta(months=6)
     near_1m = now + relativedelta(months=1)
-    for _, row in df.iterrows():
-        try:
-            exp = pd.to_datetime(row.get("Expiry"), errors="coerce")
-            if pd.isna(exp):
-                if str(row.get("Status")).strip().lower() == "in use":
-                    if current_user.get("role") == "admin" or row.get("Client") == current_user.get("client"):
-                        subject = f"[Alert] Pump {row.get('Serial Number','?')} — Missing expiry"
-                        body = f"Pump ID {row.get('Serial Number','?')} ({row.get('Model','?')}) has no expiry date assigned.\nPlease review."
-                        send_email(current_user.get("email", current_user.get("username", "admin@localhost")), subject, body)
-                continue
-            if str(row.get("Status")).strip() not in ["In use", "In stock"]:
-                continue
-            subject = None
-            if exp.date() <= now.date():
-                subject = "Pump expired and still in use/stock"
-            elif now < exp <= near_1m:
-                subject = "Pump expiring within 1 month"
-            elif now < exp <= near_6m:
-                subject = "Pump expiring within 6 months"
-            if subject and (current_user.get("role") == "admin" or row.get("Client") == current_user.get("client")):
-                body = (f"Pump ID {row.get('Serial Number','?')} ({row.get('Model','?')}) flagged:\n\n"
-                        f"Status: {row.get('Status')}\nExpiry: {exp.date()}\nClient: {row.get('Client','-')}\nNotes: {row.get('Notes','-')}")
-                send_email(current_user.get("email", current_user.get("username", "admin@localhost")),
-                           f"[Alert] {row.get('ID','?')} - {subject}", body)
-        except Exception:
+    to_email = current_user.get("email", current_user.get("username", "admin@localhost"))
+    outbox = []
+    if current_user.get("role") == "admin":
+        visible = pd.Series(True, index=df.index)
+    else:
+        visible = df["Client"] == current_user.get("client")
+    exp = pd.to_datetime(df["Expiry"], errors="coerce")
+    in_use_stock = visible & df["Status"].isin(["In use", "In stock"])
+    m_expired = in_use_stock & (exp.dt.normalize() <= pd.Timestamp(now.date()))
+    m_1m = in_use_stock & (exp > now) & (exp <= near_1m)
+    m_6m = in_use_stock & (exp > now) & (exp <= near_6m)
+    m_missing = visible & exp.isna() & (df["Status"] == "In use")
+    subjects = np.select(
+        [m_expired, m_1m, m_6m, m_missing],
+        ["Pump expired and still in use/stock", "Pump expiring within 1 month",
+         "Pump expiring within 6 months", MISSING_EXPIRY],
+        default=None,
+    )
+    flagged = df.assign(_exp=exp, _subject=subjects).loc[lambda d: d["_subject"].notna()]
+    cols = ["ID", "Serial Number", "Model", "Status", "Client", "Notes", "_exp", "_subject"]
+    for pid, serial, model, row_status, row_client, notes, row_exp, subject in flagged[cols].itertuples(index=False, name=None):
+        if subject == MISSING_EXPIRY:
+            outbox.append((to_email, f"[Alert] Pump {serial} — Missing expiry",
+                           f"Pump ID {serial} ({model}) has no expiry date assigned.\nPlease review."))
             continue
+        body = (f"Pump ID {serial} ({model}) flagged:\n\n"
+                f"Status: {row_status}\nExpiry: {row_exp.date()}\nClient: {row_client}\nNotes: {notes}")
+        outbox.append((to_email, f"[Alert] {pid} - {subject}", body))
     # Additional CRONO SC patient checks
-    cronos = df[df["Model"].str.contains("CRONO SC", case=False, na=False)]
-    for _, r in cronos.iterrows():
-        pid = r.get("Patient")
-        if is_empty(pid):
-            if current_user.get("role") == "admin" or r.get("Client") == current_user.get("client"):
-                send_email(current_user.get("email", current_user.get("username", "admin@localhost")),
-                           f"[Alert] CRONO SC {r.get('Serial Number','?')} — no patient assigned",
-                           f"CRONO SC pump {r.get('Serial Number','?')} (serial {r.get('Serial Number','-')}) has no Patient assigned. Please assign a Patient (2 pumps per patient).")
-    if not cronos.empty:
-        patient_counts = cronos.groupby("Patient").size()
-        for patient, count in patient_counts.items():
-            if is_empty(patient):
-                continue
-            if count == 1:
-                sample = cronos[cronos["Patient"] == patient].iloc[0]
-                if current_user.get("role") == "admin" or sample.get("Client") == current_user.get("client"):
-                    body = (f"Patient {patient} currently has only {count} CRONO SC pump assigned.\n\n"
-                            f"Pump details:\n"
-                            f"ID: {sample.get('ID','-')}\n"
-                            f"Model: {sample.get('Model','-')}\n"
-                            f"Client: {sample.get('Client','-')}\n"
-                            f"Expiry: {sample.get('Expiry','-')}\n"
-                            f"Status: {sample.get('Status','-')}\n"
-                            f"Serial Number: {sample.get('Serial Number','-')}\n"
-                            f"Notes: {sample.get('Notes','-')}")
-                    send_email(current_user.get("email", current_user.get("username", "admin@localhost")),
-                               f"[Alert] Patient {patient} has only 1 CRONO SC pump", body)
+    is_crono = df["_is_crono"]
+    cronos = df[is_crono]
+    crono_visible = visible[is_crono]
+    no_patient = cronos["Patient"].fillna("").str.strip() == ""
+    for serial in cronos.loc[no_patient & crono_visible, "Serial Number"]:
+        outbox.append((to_email,
+                       f"[Alert] CRONO SC {serial} — no patient assigned",
+                       f"CRONO SC pump {serial} (serial {serial}) has no Patient assigned. Please assign a Patient (2 pumps per patient)."))
+    counts = cronos.loc[~no_patient, "Patient"].value_counts(dropna=True)
+    singles = counts[counts == 1].index
+    samples = cronos[cronos["Patient"].isin(singles) & crono_visible].drop_duplicates("Patient")
+    cols = ["Patient", "ID", "Model", "Client", "Expiry", "Status", "Serial Number", "Notes"]
+    for patient, pid, model, row_client, row_exp, row_status, serial, notes in samples[cols].itertuples(index=False, name=None):
+        body = (f"Patient {patient} currently has only 1 CRONO SC pump assigned.\n\n"
+                f"Pump details:\n"
+                f"ID: {pid}\n"
+                f"Model: {model}\n"
+                f"Client: {row_client}\n"
+                f"Expiry: {row_exp}\n"
+                f"Status: {row_status}\n"
+                f"Serial Number: {serial}\n"
+                f"Notes: {notes}")
+        outbox.append((to_email, f"[Alert] Patient {patient} has only 1 CRONO SC pump", body))
+    send_batch(outbox)
+    st.session_state[key] = True
 
 # ---------------------------
 # Editable Pump UI
@@ -273,7 +422,7 @@ def render_editable_pump(row, idx, df):
         return fallback or datetime.now().date()
 
     expiry_default = safe_date(row.get("Expiry"))
-    with st.expander(f"{safe_str(row.get('Serial Number'))} — {safe_str(row.get('Model'))}"):
+    with st.expander(f"{safe_str(row.get('Serial Number'))} — {safe_str(row.get('Model'))}", expanded=True):
         m = st.text_input("Model", value=safe_str(row.get("Model")), key=f"model_{idx}")
         y = st.text_input("Year", value=safe_str(row.get("Year")), key=f"year_{idx}")
         try:
@@ -286,7 +435,7 @@ def render_editable_pump(row, idx, df):
         e = st.date_input("Expiry", value=expiry_default, key=f"expiry_{idx}")
         q_sold = st.number_input("Quantity Sold", value=safe_int(row.get("Quantity Sold")), min_value=0, step=1, key=f"qty_{idx}")
         serial = st.text_input("Serial Number", value=safe_str(row.get("Serial Number")), key=f"serial_{idx}")
-        is_crono = "CRONO SC" in safe_str(m).upper()
+        is_crono = is_crono_model(safe_str(m))
         original_patient = row.get("Patient", pd.NA)
         original_patient_str = safe_str(original_patient)
         if is_crono:
@@ -308,7 +457,7 @@ def render_editable_pump(row, idx, df):
                                f"[Warning] Attempted patient change on {safe_str(row.get('Serial Number'))}",
                                f"An attempt was made to change the patient on pump {safe_str(row.get('Serial Number'))}. Change was prevented.")
                     return
-                existing_count = df[(df["Model"].str.contains("CRONO SC", case=False, na=False)) & (df["Patient"] == assigned_patient)].shape[0]
+                existing_count = df[df["_is_crono"] & (df["Patient"] == assigned_patient)].shape[0]
                 if existing_count >= 2 and assigned_patient != original_patient_str:
                     st.error(f"Patient {assigned_patient} already has {existing_count} CRONO SC pumps. Max 2 allowed.")
                     return
@@ -322,13 +471,14 @@ def render_editable_pump(row, idx, df):
                     "Expiry": pd.Timestamp(e),
                     "Quantity Sold": safe_int(q_sold),
                     "Serial Number": serial,
-                    "Last Updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    "Last Updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "_is_crono": is_crono,
                 }
-                for col, val in update_vals.items():
-                    df.loc[df["ID"] == row["ID"], col] = val
                 if is_crono:
-                    new_patient_val = original_patient_str if (not is_empty(original_patient)) else st.session_state.get(f"patient_{idx}", "").strip()
-                    df.loc[df["ID"] == row["ID"], "Patient"] = new_patient_val
+                    update_vals["Patient"] = original_patient_str if (not is_empty(original_patient)) else st.session_state.get(f"patient_{idx}", "").strip()
+                # idx is the row's label in df (filtered views keep df's index), so no ID scan is needed
+                add_categories(df, update_vals)
+                df.loc[idx, list(update_vals)] = list(update_vals.values())
                 if save_db(df):
                     st.success("Saved!")
                     st.rerun()
@@ -337,41 +487,54 @@ def render_editable_pump(row, idx, df):
             except Exception as e:
                 st.error(f"Error saving: {e}")
 
+def render_pump_registry(df_filtered, df, context="default"):
+    st.dataframe(df_filtered.drop(columns=["_is_crono"], errors="ignore"), use_container_width=True, hide_index=True)
+    if df_filtered.empty:
+        return
+    labels = (df_filtered["Serial Number"].astype("string").fillna("") + " — "
+              + df_filtered["Model"].astype("string").fillna("")
+              + " (" + df_filtered["ID"].astype("string").fillna("") + ")")
+    labels = dict(zip(df_filtered.index, labels))
+    idx = st.selectbox("Edit pump", list(labels), format_func=labels.get, key=f"{context}_edit_pump")
+    render_editable_pump(df_filtered.loc[idx], idx, df)
+
 # ---------------------------
 # Warnings panel (scrollable)
 # ---------------------------
 def render_warnings(df, user):
     st.subheader("Warnings")
-    dfw = apply_filters(df.copy(), user, context="warnings")
+    # apply_filters and assign never mutate their input, so no defensive copy is needed
+    dfw = apply_filters(df, user, context="warnings")
     now = datetime.now()
     near_6m = now + relativedelta(months=6)
     expiry_parsed = pd.to_datetime(dfw["Expiry"], errors="coerce")
     cond_expiry_soon = (expiry_parsed <= near_6m) & (dfw["Status"].isin(["In use", "In stock"]))
-    cond_missing_patient = (
-        dfw["Model"].str.contains("CRONO SC", case=False, na=False) &
-        (dfw["Patient"].fillna("").astype(str).str.strip() == "")
-    )
-    warning_df = dfw[cond_expiry_soon | cond_missing_patient].copy()
-    warning_df["WarningType"] = None
-    warning_df.loc[cond_expiry_soon, "WarningType"] = "Expiry"
-    warning_df.loc[cond_missing_patient, "WarningType"] = "Missing patient"
+    is_crono = dfw["_is_crono"]
+    patient_blank = dfw["Patient"].fillna("").str.strip() == ""
+    cond_missing_patient = is_crono & patient_blank
+    flagged = cond_expiry_soon | cond_missing_patient
     # Single-pump patients
-    cronos = dfw[dfw["Model"].str.contains("CRONO SC", case=False, na=False)]
-    if not cronos.empty:
-        patient_counts = cronos.groupby("Patient").size()
-        single_patients = [p for p, c in patient_counts.items() if (c == 1 and not is_empty(p))]
-        for patient in single_patients:
-            sample = cronos[cronos["Patient"] == patient].iloc[0].copy()
-            sample["WarningType"] = f"Patient {patient} has only 1 CRONO SC pump"
-            warning_df = pd.concat([warning_df, pd.DataFrame([sample])], ignore_index=True)
-    if warning_df.empty:
+    cronos = dfw[is_crono & ~patient_blank]
+    counts = cronos["Patient"].value_counts(dropna=True)
+    singles = counts[counts == 1].index
+    if not flagged.any() and singles.empty:
         st.success("No warnings.")
         return
 
+    warning_df = dfw[flagged].assign(WarningType=np.select(
+        [cond_missing_patient[flagged], cond_expiry_soon[flagged]],
+        ["Missing patient", "Expiry"],
+        default="Warning",
+    ))
+    single_rows = cronos[cronos["Patient"].isin(singles)].drop_duplicates("Patient").assign(
+        WarningType=lambda d: "Patient " + d["Patient"].astype(str) + " has only 1 CRONO SC pump")
+    warning_df = pd.concat([warning_df, single_rows], ignore_index=True)
+
     # Filter by warning type
     warning_types = sorted(warning_df["WarningType"].dropna().unique())
     selected_types = st.multiselect("Filter by warning type", warning_types, default=warning_types)
-    warning_df = warning_df[warning_df["WarningType"].isin(selected_types)]
+    if set(selected_types) != set(warning_types):
+        warning_df = warning_df[warning_df["WarningType"].isin(selected_types)]
 
     with st.container():
         st.markdown("<div style='max-height: 400px; overflow-y: auto;'>", unsafe_allow_html=True)
@@ -387,11 +550,37 @@ def render_warnings(df, user):
         st.markdown("</div>", unsafe_allow_html=True)
 
 # ---------------------------
-# Load config and authenticator
+# Analytics
 # ---------------------------
-with open("config.yaml") as f:
-    config = yaml.load(f, Loader=SafeLoader)
+ANALYTICS_COLUMNS = ["Year", "Model", "Client", "Quantity Sold"]
+
+@st.cache_data(ttl=DB_CACHE_TTL)
+def _analytics_aggs(sales):
+    base = sales.groupby(["Year", "Model", "Client"], observed=True, dropna=False)["Quantity Sold"].sum().reset_index()
+    qty_by_year = base.groupby("Year", dropna=True)["Quantity Sold"].sum().reset_index()
+    model_year = base.groupby(["Year", "Model"], observed=True, dropna=True)["Quantity Sold"].sum().reset_index()
+    client_sales = (base.groupby("Client", observed=True, dropna=True)["Quantity Sold"].sum().reset_index()
+                    .sort_values("Quantity Sold", ascending=False))
+    return qty_by_year, model_year, client_sales
+
+def analytics_aggs(df):
+    # Cached on the content of the sales columns, so reruns that don't touch the data skip the groupbys
+    if not set(ANALYTICS_COLUMNS).issubset(df.columns):
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+    return _analytics_aggs(df[ANALYTICS_COLUMNS])
 
+# ---------------------------
+# Load config and authenticator
+# ---------------------------
+@st.cache_data
+def get_config():
+    with open("config.yaml") as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+# Authenticate is built on every run on purpose: it renders the cookie
+# manager component and seeds per-session state, so it cannot be shared
+# through st.cache_resource.
+config = get_config()
 authenticator = stauth.Authenticate(
     config["credentials"],
     config["cookie"]["name"],
@@ -413,7 +602,8 @@ if auth_status:
     role = user.get("role", "user")
     client = user.get("client")
 
-    df = load_db()
+    # Non-admins only ever read their own client's rows from the store
+    df = get_db(None if role == "admin" else client)
     try:
         check_expirations(df, user)
     except Exception as e:
@@ -426,16 +616,13 @@ if auth_status:
         with tab1:
             st.header("Pump Registry")
             df_filtered = apply_filters(df, user, context="admin_edit")
-            with st.container():
-                st.markdown("<div style='max-height: 550px; overflow-y: auto;'>", unsafe_allow_html=True)
-                for idx, row in df_filtered.iterrows():
-                    render_editable_pump(row, idx, df)
-                st.markdown("</div>", unsafe_allow_html=True)
+            render_pump_registry(df_filtered, df, context="admin_edit")
 
             st.markdown("---")
             st.subheader("Admin actions")
             if st.button("Recompute expiries from ID dates"):
-                df["Expiry"] = df["ID"].apply(lambda i: (parse_date_from_id(i) + relativedelta(years=FIXED_EXPIRY_YEARS)) if pd.notna(parse_date_from_id(i)) else pd.NaT)
+                id_dates = parse_dates_from_ids(df["ID"])
+                df["Expiry"] = (id_dates + pd.DateOffset(years=FIXED_EXPIRY_YEARS)).where(id_dates.notna(), pd.NaT)
                 if save_db(df):
                     st.success("Expiries updated.")
                     st.rerun()
@@ -444,10 +631,7 @@ if auth_status:
 
         with tab2:
             st.header("Analytics")
-            if "Year" in df.columns and "Quantity Sold" in df.columns:
-                qty_by_year = df.groupby("Year", dropna=True)["Quantity Sold"].sum().reset_index()
-            else:
-                qty_by_year = pd.DataFrame()
+            qty_by_year, model_year, client_sales = analytics_aggs(df)
             if not qty_by_year.empty:
                 st.plotly_chart(
                     px.bar(qty_by_year.sort_values("Year"), x="Year", y="Quantity Sold",
@@ -457,10 +641,6 @@ if auth_status:
             else:
                 st.info("No sales data to show.")
 
-            if {"Year", "Model", "Quantity Sold"}.issubset(df.columns):
-                model_year = df.groupby(["Year", "Model"], dropna=True)["Quantity Sold"].sum().reset_index()
-            else:
-                model_year = pd.DataFrame()
             if not model_year.empty:
                 fig = px.bar(model_year, x="Year", y="Quantity Sold", color="Model",
                              title="Quantity Sold by Model per Year")
@@ -469,10 +649,6 @@ if auth_status:
                 st.info("No model/year data to show.")
 
             st.markdown("**Quantity Sold per Client**")
-            if {"Client", "Quantity Sold"}.issubset(df.columns):
-                client_sales = df.groupby("Client", dropna=True)["Quantity Sold"].sum().reset_index().sort_values("Quantity Sold", ascending=False)
-            else:
-                client_sales = pd.DataFrame()
             if not client_sales.empty:
                 st.plotly_chart(
                     px.bar(client_sales, x="Client", y="Quantity Sold", title="Quantity Sold per Client",
@@ -484,21 +660,24 @@ if auth_status:
 
             st.markdown("---")
             st.subheader("Raw data preview")
-            st.dataframe(df.head(200), use_container_width=True)
+            st.dataframe(df.head(200).drop(columns=["_is_crono"], errors="ignore"), use_container_width=True)
 
     else:
         # Non-admin client view
         st.header(f"Client: {client}")
-        user_df = df[df["Client"] == client]
+        # load_db already pushed the client filter down to the Parquet read
+        user_df = df if client is not None else df.iloc[0:0]
         df_filtered = apply_filters(user_df, user, context="user_edit")
-        with st.container():
-            st.markdown("<div style='max-height: 550px; overflow-y: auto;'>", unsafe_allow_html=True)
-            for idx, row in df_filtered.iterrows():
-                render_editable_pump(row, idx, df)
-            st.markdown("</div>", unsafe_allow_html=True)
+        render_pump_registry(df_filtered, df, context="user_edit")
 
         st.markdown("---")
         st.subheader("Add New Pump")
+        unsaved = st.session_state.get("_pending_rows")
+        if unsaved:
+            st.warning(f"{len(unsaved)} pump(s) not saved yet; they will be saved with the next pump you add.")
+            if st.button("Discard unsaved pumps", key="discard_pending"):
+                unsaved.clear()
+                st.rerun()
         with st.form("add_pump_form"):
             new_id = st.text_input("Pump ID", key="new_id")
             new_model = st.text_input("Model", key="new_model")
@@ -514,17 +693,17 @@ if auth_status:
             else:
                 default_expiry = (datetime.now().date() + relativedelta(years=FIXED_EXPIRY_YEARS))
             new_expiry = st.date_input("Expiry Date", value=default_expiry, key="new_expiry")
-            new_patient = "" if "CRONO SC" not in str(new_model).upper() else st.text_input("Patient (required for CRONO SC)", key="new_patient")
+            new_patient = "" if not is_crono_model(new_model) else st.text_input("Patient (required for CRONO SC)", key="new_patient")
             submitted = st.form_submit_button("Add Pump")
             if submitted:
                 if new_id.strip() == "" or new_model.strip() == "":
                     st.error("Pump ID and Model are required.")
                 else:
-                    if "CRONO SC" in str(new_model).upper():
+                    if is_crono_model(new_model):
                         if is_empty(new_patient):
                             st.error("CRONO SC pumps must have a patient assigned.")
                         else:
-                            existing_count = df[(df["Model"].str.contains("CRONO SC", case=False, na=False)) & (df["Patient"] == new_patient)].shape[0]
+                            existing_count = df[df["_is_crono"] & (df["Patient"] == new_patient)].shape[0] + pending_patient_count(new_patient, (new_id, new_serial))
                             if existing_count >= 2:
                                 st.error(f"Patient {new_patient} already has {existing_count} CRONO SC pumps. Max 2 allowed.")
                             else:
@@ -539,11 +718,13 @@ if auth_status:
                                     "Serial Number": new_serial,
                                     "Expiry": pd.Timestamp(new_expiry),
                                     "Patient": new_patient,
-                                    "Last Updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                                    "Last Updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                    "_is_crono": True,
                                 }
                                 try:
-                                    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                                    if save_db(df):
+                                    queue_pending_row(new_row)
+                                    df, saved = flush_pending_rows(df)
+                                    if saved:
                                         st.success("Pump added!")
                                         st.rerun()
                                     else:
@@ -562,11 +743,13 @@ if auth_status:
                             "Serial Number": new_serial,
                             "Expiry": pd.Timestamp(new_expiry),
                             "Patient": pd.NA,
-                            "Last Updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                            "Last Updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            "_is_crono": False,
                         }
                         try:
-                            df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                            if save_db(df):
+                            queue_pending_row(new_row)
+                            df, saved = flush_pending_rows(df)
+                            if saved:
                                 st.success("Pump added!")
                                 st.rerun()
                             else: